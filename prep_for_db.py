@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
+import argparse
 import sys
+import os
+import struct
+from decimal import Decimal, ROUND_HALF_EVEN
 import urllib.request
 import re
 from bs4 import BeautifulSoup
@@ -7,31 +11,292 @@ from collections import defaultdict
 from unidecode import unidecode
 import itertools
 import time
-import csv
 
 LV = '187'  # Language variety ID for English
 REASON = "special_char"
 NULL = '\\N'
 
+# db record has following rows: int lv, int bad, text good, numeric score, text reason, text comment
+COLUMN_TYPES = ['int', 'int', 'text', 'numeric', 'text', 'text']
+
+# scores are handled as integer hundredths and written with two decimal places
+SCORE_DSCALE = 2
+
+# PostgreSQL binary COPY framing: 11-byte signature, int32 flags, int32 header
+# extension length, then one tuple per row and an int16 -1 trailer
+PGCOPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+PGCOPY_HEADER = PGCOPY_SIGNATURE + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+
+INT16 = struct.Struct('!h')
+INT32 = struct.Struct('!i')
+INT_FIELD = struct.Struct('!ii')
+NUMERIC_HEADER = struct.Struct('!hhhh')
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+
+# text COPY treats backslash, tab, newline and carriage return specially, so
+# these have to be escaped in the text fields of TSV output
+COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+# every row shares the same lv, reason and comment, so pack those fields once
+REASON_BYTES = REASON.encode('utf-8')
+BINARY_ROW_PREFIX = INT16.pack(len(COLUMN_TYPES)) + INT_FIELD.pack(4, int(LV))
+BINARY_ROW_SUFFIX = INT32.pack(len(REASON_BYTES)) + REASON_BYTES + INT32.pack(-1)
+TSV_ROW_SUFFIX = '\t{}\t{}\n'.format(REASON.translate(COPY_TEXT_ESCAPES), NULL)
+
 # Utility function for printing text to stderr.
 # 
 def eprint(*args, **kwargs):
     print("[[DEBUG]] ", *args, file=sys.stderr, **kwargs)
 
 
-if __name__ == '__main__':
+# Parse out arguments from command line and return them as a big ol' tuple.
+# 
+def check_args(args=None):
+    parser = argparse.ArgumentParser(description='Prepare error correction candidates for loading into the db.')
     
-    db_fn = sys.argv[1]
-    baddies_fn = sys.argv[2]
-    output_fn = sys.argv[3]
+    parser.add_argument('db_fn', metavar='db_file', type=str,
+        help='path to CSV dump of expressions (id, text, dncount)')
+    parser.add_argument('baddies_fn', metavar='baddies_file', type=str,
+        help='path to list of bad expressions')
+    parser.add_argument('output_fn', metavar='output_file', type=str,
+        help='path to output file')
+    parser.add_argument('-f', '--format', choices=['tsv', 'binary'], default='tsv',
+        help='output format: tsv or PostgreSQL binary COPY (defaults to tsv)')
+    parser.add_argument('-c', '--chunk_rows', metavar='<N>', type=int, default=0,
+        help='start a new output file every N rows')
+    parser.add_argument('-s', '--shards', metavar='<N>', type=int, default=1,
+        help='spread rows round-robin across N output files')
+
+    results = parser.parse_args(args)
+    if results.chunk_rows and results.shards > 1:
+        parser.error('--chunk_rows and --shards cannot be combined')
+    if results.chunk_rows < 0:
+        parser.error('--chunk_rows must be >= 0')
+    if results.shards < 1:
+        parser.error('--shards must be >= 1')
+    return (results.db_fn, results.baddies_fn, results.output_fn,
+            results.format, results.chunk_rows, results.shards)
+
+
+# Returns the score for replacing an expression with $old_count references by
+# one with $new_count references, in integer hundredths. The ratio is rounded
+# exactly as '{:.2f}' rounds the float, so scores match the original TSV output.
+# 
+def get_score(new_count, old_count):
+    ratio = Decimal(new_count / old_count)
+    return int(ratio.quantize(Decimal('0.01'), ROUND_HALF_EVEN).scaleb(2))
+
+
+# Encodes a number as the body of a PostgreSQL binary numeric: a header of
+# (ndigits, weight, sign, dscale) followed by base-10000 digits, most
+# significant first. Weight is the base-10000 exponent of the first digit.
+# $units is the value as an integer count of 10^-dscale, e.g. 1234 with a
+# dscale of 2 for 12.34. dscale can be at most 4.
+# 
+def encode_numeric(units, dscale=SCORE_DSCALE):
+    sign = NUMERIC_NEG if units < 0 else NUMERIC_POS
     
-    db_lines = [line.rstrip('\n') for line in open(db_fn)]
-    baddies = [line.rstrip('\n') for line in open(baddies_fn)]
+    # scale up to exactly one base-10000 digit after the decimal point, then
+    # peel off the integer digits, least significant first
+    int_part, frac = divmod(abs(units) * 10 ** (4 - dscale), 10000)
+    groups = [frac]
+    while int_part:
+        int_part, group = divmod(int_part, 10000)
+        groups.insert(0, group)
+    weight = len(groups) - 2
+    
+    # leading and trailing zero groups are implied by weight and dscale
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    
+    return (NUMERIC_HEADER.pack(len(groups), weight, sign, dscale)
+            + struct.pack('!{}h'.format(len(groups)), *groups))
+
+
+# Inverse of encode_numeric(): turns the body of a binary numeric back into a
+# Decimal with the original display scale.
+# 
+def decode_numeric(data):
+    ndigits, weight, sign, dscale = NUMERIC_HEADER.unpack_from(data)
+    groups = struct.unpack_from('!{}h'.format(ndigits), data, NUMERIC_HEADER.size)
+    value = sum((Decimal(group).scaleb(4 * (weight - i)) for i, group in enumerate(groups)), Decimal(0))
+    if sign == NUMERIC_NEG:
+        value = -value
+    return value.quantize(Decimal(1).scaleb(-dscale))
+
+
+# Returns the binary COPY representation of one row, given the expression ID
+# of the bad expression, the text of the good one, and the score in integer
+# hundredths. The lv, reason and comment fields are constant.
+# 
+def encode_binary_row(bad, good, score):
+    good_bytes = good.encode('utf-8')
+    numeric = encode_numeric(score)
+    return b''.join((BINARY_ROW_PREFIX, INT_FIELD.pack(4, bad),
+                     INT32.pack(len(good_bytes)), good_bytes,
+                     INT32.pack(len(numeric)), numeric,
+                     BINARY_ROW_SUFFIX))
+
+
+# Returns the line written to the TSV output for one row, in the text format
+# read by \copy: tab-separated, with the score formatted to two decimal places
+# and special characters in the text escaped.
+# 
+def format_tsv_row(bad, good, score):
+    return '{}\t{}\t{}\t{}.{:02d}'.format(LV, bad, good.translate(COPY_TEXT_ESCAPES),
+                                         *divmod(score, 100)) + TSV_ROW_SUFFIX
+
+
+# Reads back a PostgreSQL binary COPY file and returns its rows as lists of
+# Python values: ints, Decimals and strings, with None for null fields. Used by
+# the tests to check binary output offline, without a database.
+# 
+def read_binary_copy(fn, types=COLUMN_TYPES):
+    with open(fn, 'rb') as infile:
+        data = infile.read()
+    
+    if not data.startswith(PGCOPY_SIGNATURE):
+        raise ValueError('{} is not a binary COPY file'.format(fn))
+    offset = len(PGCOPY_SIGNATURE)
+    (flags, ext_len) = struct.unpack_from('!ii', data, offset)
+    if flags != 0:
+        raise ValueError('{} has unexpected header flags {:#x}'.format(fn, flags))
+    offset += 8 + ext_len
     
+    rows = []
+    while True:
+        (nfields,) = INT16.unpack_from(data, offset)
+        offset += INT16.size
+        if nfields == -1:
+            break
+        if nfields != len(types):
+            raise ValueError('{} has a row with {} fields, expected {}'.format(
+                fn, nfields, len(types)))
+        
+        row = []
+        for type_ in types:
+            (length,) = INT32.unpack_from(data, offset)
+            offset += INT32.size
+            if length == -1:
+                row.append(None)
+                continue
+            
+            field = data[offset:offset+length]
+            offset += length
+            if type_ == 'int':
+                row.append(INT32.unpack(field)[0])
+            elif type_ == 'numeric':
+                row.append(decode_numeric(field))
+            else:
+                row.append(field.decode('utf-8'))
+        rows.append(row)
+    
+    if offset != len(data):
+        raise ValueError('{} has {} bytes of trailing data'.format(fn, len(data) - offset))
+    return rows
+
+
+# Writes rows out as they're produced, rather than collecting them all first.
+# Output is either TSV or PostgreSQL binary COPY, and can be split across
+# several files for parallel loading: either a new file every $chunk_rows
+# rows, or round-robin across $shards files. Split files are named after
+# $output_fn with a number appended, e.g. my_errors-000.tsv, my_errors-001.tsv.
+# 
+# Use it as a context manager: if anything goes wrong before it's closed, all
+# of its files are deleted rather than left half-written but loadable-looking.
+# 
+class RowWriter:
+    def __init__(self, output_fn, fmt='tsv', chunk_rows=0, shards=1):
+        self.output_fn = output_fn
+        self.fmt = fmt
+        self.chunk_rows = chunk_rows
+        self.shards = shards
+        self.count = 0
+        self.files = []
+        self.filenames = []
+        
+        # don't leave earlier shards behind if opening a later one fails
+        try:
+            for _ in range(shards):
+                self._open_file()
+        except BaseException:
+            self.discard()
+            raise
+    
+    def _filename(self, index):
+        if not self.chunk_rows and self.shards == 1:
+            return self.output_fn
+        base, ext = os.path.splitext(self.output_fn)
+        return '{}-{:03d}{}'.format(base, index, ext)
+    
+    def _open_file(self):
+        fn = self._filename(len(self.filenames))
+        if self.fmt == 'binary':
+            outfile = open(fn, 'wb')
+            outfile.write(PGCOPY_HEADER)
+        else:
+            outfile = open(fn, 'w', newline='')
+        
+        self.filenames.append(fn)
+        self.files.append(outfile)
+    
+    def _close_file(self, index):
+        if self.fmt == 'binary':
+            self.files[index].write(PGCOPY_TRAILER)
+        self.files[index].close()
+    
+    def write_row(self, bad, good, score):
+        if self.chunk_rows:
+            if self.count and self.count % self.chunk_rows == 0:
+                self._close_file(-1)
+                self._open_file()
+            index = -1
+        else:
+            index = self.count % self.shards
+        
+        if self.fmt == 'binary':
+            self.files[index].write(encode_binary_row(bad, good, score))
+        else:
+            self.files[index].write(format_tsv_row(bad, good, score))
+        self.count += 1
+    
+    def close(self):
+        # earlier chunks were already closed as we moved past them
+        indices = [-1] if self.chunk_rows else range(len(self.files))
+        for index in indices:
+            self._close_file(index)
+    
+    def discard(self):
+        for outfile in self.files:
+            outfile.close()
+        for fn in self.filenames:
+            if os.path.exists(fn):
+                os.remove(fn)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+# Loads the database dump into two dicts: good expressions keyed by their
+# unidecoded text, and bad expressions (those in $baddies_set) keyed by their
+# text. Each value is a dict of the expression's id, text and reference count.
+# 
+def load_exprs(db_lines, baddies_set):
     count = 0
     exprs_by_unided = {}
-    
-    baddies_set = set(baddies)
     exprs_by_baddie = {}
     
     eprint("loading database dump ... ")
@@ -41,17 +306,25 @@ if __name__ == '__main__':
         
         # don't include bad expressions in exprs_by_unided
         if tt not in baddies_set:
-            exprs_by_unided[unidecode(tt)] = {'id' : exid, 'tt' : tt, 'dncount' : int(dncount)}
+            exprs_by_unided[unidecode(tt)] = {'id' : int(exid), 'tt' : tt, 'dncount' : int(dncount)}
         else:
-            exprs_by_baddie[tt] = {'id' : exid, 'tt' : tt, 'dncount' : int(dncount)}
+            exprs_by_baddie[tt] = {'id' : int(exid), 'tt' : tt, 'dncount' : int(dncount)}
 
         count+=1
         if count % 100000 == 0: eprint('{}: {}'.format(count, tt))
     eprint("finished loading!")
     eprint("{} expressions in exprs_by_unided".format(len(exprs_by_unided)))
     
+    return exprs_by_unided, exprs_by_baddie
+
+
+# Matches each bad expression to a good one with the same unidecoded text and
+# writes a candidate row to $writer for whichever direction the reference
+# counts favour (both, if they're equal). Returns the list of bad expressions
+# that had no match in the database.
+# 
+def write_candidates(baddies, exprs_by_unided, exprs_by_baddie, writer):
     count = 0
-    rows = []
     nofindums = []
     for baddie in baddies:
         
@@ -69,20 +342,32 @@ if __name__ == '__main__':
         
         # db record has following rows: int lv, int bad, text good, numeric score, text reason, text comment
         if new_count >= old_count:
-            rows.append([LV, old_expr['id'], new_expr['tt'], '{0:.2f}'.format(new_count / old_count), REASON, NULL])
+            row = (old_expr['id'], new_expr['tt'], get_score(new_count, old_count))
+            writer.write_row(*row)
         
         if old_count >= new_count:
-            rows.append([LV, new_expr['id'], old_expr['tt'], '{0:.2f}'.format(old_count / new_count), REASON, NULL])
+            row = (new_expr['id'], old_expr['tt'], get_score(old_count, new_count))
+            writer.write_row(*row)
 
         count+=1            
-        if count % 1000 == 0: eprint('{}: {}'.format(count, ','.join(rows[-1])))
+        if count % 1000 == 0: eprint('{}: {}'.format(count, row))
     
-    eprint("couldn't match {} expressions to db file".format(len(nofindums)))
-    eprint(nofindums[0:10])
-
-    with open(output_fn, 'w') as outfile:
-        csvwriter = csv.writer(outfile, delimiter='\t', lineterminator="\n")
-        for row in rows:
-            csvwriter.writerow(row)
+    return nofindums
 
 
+if __name__ == '__main__':
+    
+    # parse args from command line
+    (db_fn, baddies_fn, output_fn, fmt, chunk_rows, shards) = check_args(sys.argv[1:])
+    
+    db_lines = [line.rstrip('\n') for line in open(db_fn)]
+    baddies = [line.rstrip('\n') for line in open(baddies_fn)]
+    
+    exprs_by_unided, exprs_by_baddie = load_exprs(db_lines, set(baddies))
+    
+    with RowWriter(output_fn, fmt, chunk_rows, shards) as writer:
+        nofindums = write_candidates(baddies, exprs_by_unided, exprs_by_baddie, writer)
+    
+    eprint("couldn't match {} expressions to db file".format(len(nofindums)))
+    eprint(nofindums[0:10])
+    eprint("wrote {} rows to {}".format(writer.count, ', '.join(writer.filenames)))
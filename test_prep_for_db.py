@@ -0,0 +1,223 @@
+import os
+import struct
+from decimal import Decimal
+
+import pytest
+
+import prep_for_db
+from prep_for_db import (RowWriter, encode_numeric, decode_numeric,
+                         read_binary_copy, get_score, load_exprs,
+                         write_candidates, NULL, REASON, LV)
+
+
+# (bad, good, score in hundredths) triples, as passed to RowWriter.write_row()
+ROWS = [
+    (101, 'cafe', 200),
+    (102, 'naïve\twith tab', 50),
+    (103, 'résumé', 1),
+    (104, 'hello', 100),
+    (105, 'big', 9999999999),
+    (106, 'huge', 1000000),
+    (107, 'zero', 0),
+    (108, 'back\\slash\nnewline\rreturn', 123),
+]
+
+# a small database dump and list of bad expressions, with the TSV output the
+# original (pre-streaming) version of prep_for_db.py produced for them
+DB_LINES = [
+    '1,café,40',
+    '2,cafe,43',
+    '3,naïve,57',
+    '4,naive,40',
+    '5,résumé,10',
+    '6,resume,10',
+    '7,Ñandú,3',
+    '9,uber,2',
+]
+BADDIES = ['café', 'naïve', 'résumé', 'Ñandú', 'über']
+BASELINE_TSV = (
+    '187\t1\tcafe\t1.07\tspecial_char\t\\N\n'
+    '187\t4\tnaïve\t1.43\tspecial_char\t\\N\n'
+    '187\t5\tresume\t1.00\tspecial_char\t\\N\n'
+    '187\t6\trésumé\t1.00\tspecial_char\t\\N\n'
+).encode('utf-8')
+
+
+def expected_binary_rows(rows):
+    return [[int(LV), bad, good, Decimal(score).scaleb(-2), REASON, None]
+            for bad, good, score in rows]
+
+
+def write_rows(fn, fmt, rows=ROWS, **kwargs):
+    with RowWriter(str(fn), fmt, **kwargs) as writer:
+        for row in rows:
+            writer.write_row(*row)
+    return writer
+
+
+@pytest.mark.parametrize('units, text', [
+    (0, '0.00'),
+    (50, '0.50'),
+    (1, '0.01'),
+    (100, '1.00'),
+    (1000000, '10000.00'),
+    (9999999999, '99999999.99'),
+    (123456789, '1234567.89'),
+    (-350, '-3.50'),
+])
+def test_numeric_round_trip(units, text):
+    assert str(decode_numeric(encode_numeric(units))) == text
+
+
+def test_numeric_matches_postgres_layout():
+    # 12345.67 is base-10000 digits 1, 2345, 6700 with weight 1
+    assert encode_numeric(1234567).hex() == '0003000100000002000109291a2c'
+    # 0.01 is a single digit 100 with weight -1
+    assert encode_numeric(1).hex() == '0001ffff000000020064'
+    # zero has no digits at all
+    assert encode_numeric(0).hex() == '0000000000000002'
+
+
+def test_binary_round_trip(tmp_path):
+    fn = tmp_path / 'my_errors.bin'
+    writer = write_rows(fn, 'binary')
+    assert writer.filenames == [str(fn)]
+    assert read_binary_copy(str(fn)) == expected_binary_rows(ROWS)
+
+
+def test_tsv_output(tmp_path):
+    fn = tmp_path / 'my_errors.tsv'
+    write_rows(fn, 'tsv', rows=ROWS[:4] + ROWS[-1:])
+    with open(str(fn), newline='') as infile:
+        lines = infile.read().split('\n')
+    assert lines == [
+        '{}\t101\tcafe\t2.00\t{}\t{}'.format(LV, REASON, NULL),
+        '{}\t102\tnaïve\\twith tab\t0.50\t{}\t{}'.format(LV, REASON, NULL),
+        '{}\t103\trésumé\t0.01\t{}\t{}'.format(LV, REASON, NULL),
+        '{}\t104\thello\t1.00\t{}\t{}'.format(LV, REASON, NULL),
+        '{}\t108\tback\\\\slash\\nnewline\\rreturn\t1.23\t{}\t{}'.format(LV, REASON, NULL),
+        '',
+    ]
+
+
+@pytest.mark.parametrize('new_count, old_count, text', [
+    (43, 40, '1.07'),
+    (57, 40, '1.43'),
+    (1, 3, '0.33'),
+    (1, 8, '0.12'),
+    (3, 8, '0.38'),
+])
+def test_score(new_count, old_count, text):
+    score = get_score(new_count, old_count)
+    assert '{}.{:02d}'.format(*divmod(score, 100)) == text
+
+
+def test_score_matches_original_formatting():
+    for new_count in range(1, 300):
+        for old_count in range(1, 300):
+            score = get_score(new_count, old_count)
+            assert ('{}.{:02d}'.format(*divmod(score, 100))
+                    == '{0:.2f}'.format(new_count / old_count))
+
+
+def write_fixture(fn, fmt):
+    exprs_by_unided, exprs_by_baddie = load_exprs(DB_LINES, set(BADDIES))
+    with RowWriter(str(fn), fmt) as writer:
+        nofindums = write_candidates(BADDIES, exprs_by_unided, exprs_by_baddie, writer)
+    return nofindums
+
+
+def test_candidates_tsv_matches_baseline(tmp_path):
+    fn = tmp_path / 'my_errors.tsv'
+    assert write_fixture(fn, 'tsv') == ['Ñandú']
+    with open(str(fn), 'rb') as infile:
+        assert infile.read() == BASELINE_TSV
+
+
+def test_candidates_binary(tmp_path):
+    fn = tmp_path / 'my_errors.bin'
+    assert write_fixture(fn, 'binary') == ['Ñandú']
+    assert read_binary_copy(str(fn)) == expected_binary_rows([
+        (1, 'cafe', 107),
+        (4, 'naïve', 143),
+        (5, 'resume', 100),
+        (6, 'résumé', 100),
+    ])
+
+
+def test_chunk_rows(tmp_path):
+    fn = tmp_path / 'my_errors.bin'
+    writer = write_rows(fn, 'binary', chunk_rows=3)
+    assert [os.path.basename(f) for f in writer.filenames] == [
+        'my_errors-000.bin', 'my_errors-001.bin', 'my_errors-002.bin']
+
+    expected = expected_binary_rows(ROWS)
+    assert [read_binary_copy(f) for f in writer.filenames] == [
+        expected[0:3], expected[3:6], expected[6:]]
+
+
+def test_shards(tmp_path):
+    fn = tmp_path / 'my_errors.bin'
+    writer = write_rows(fn, 'binary', shards=3)
+    assert [os.path.basename(f) for f in writer.filenames] == [
+        'my_errors-000.bin', 'my_errors-001.bin', 'my_errors-002.bin']
+
+    expected = expected_binary_rows(ROWS)
+    assert [read_binary_copy(f) for f in writer.filenames] == [
+        expected[0::3], expected[1::3], expected[2::3]]
+
+
+def test_open_error_discards_earlier_shards(tmp_path):
+    # the third shard's path is taken by a directory, so opening it fails
+    os.mkdir(str(tmp_path / 'my_errors-002.bin'))
+    with pytest.raises(OSError):
+        RowWriter(str(tmp_path / 'my_errors.bin'), 'binary', shards=4)
+    assert os.listdir(str(tmp_path)) == ['my_errors-002.bin']
+
+
+def test_read_binary_copy_rejects_malformed(tmp_path):
+    fn = tmp_path / 'my_errors.bin'
+    write_rows(fn, 'binary', rows=ROWS[:1])
+    with open(str(fn), 'rb') as infile:
+        data = infile.read()
+    header = data[:19]
+    row = data[19:-2]
+    trailer = data[-2:]
+
+    bad_files = {
+        'oids': header[:11] + struct.pack('!i', 1 << 16) + header[15:] + row + trailer,
+        'fields': header + struct.pack('!h', 7) + row[2:] + struct.pack('!i', -1) + trailer,
+        'trailing': header + row + trailer + b'extra',
+    }
+    for name, bad_data in bad_files.items():
+        bad_fn = tmp_path / (name + '.bin')
+        with open(str(bad_fn), 'wb') as outfile:
+            outfile.write(bad_data)
+        with pytest.raises(ValueError):
+            read_binary_copy(str(bad_fn))
+
+
+def test_error_discards_partial_files(tmp_path):
+    fn = tmp_path / 'my_errors.bin'
+    with pytest.raises(ZeroDivisionError):
+        with RowWriter(str(fn), 'binary', chunk_rows=2) as writer:
+            for row in ROWS:
+                writer.write_row(*row)
+            1 / 0
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('args, message', [
+    (['-c', '-1'], '--chunk_rows must be >= 0'),
+    (['-s', '0'], '--shards must be >= 1'),
+    (['-c', '2', '-s', '2'], 'cannot be combined'),
+])
+def test_check_args_errors(args, message, capsys):
+    with pytest.raises(SystemExit):
+        prep_for_db.check_args(['db.csv', 'bad.txt', 'out.tsv'] + args)
+    assert message in capsys.readouterr().err
+
+
+def test_check_args_defaults():
+    assert prep_for_db.check_args(['db.csv', 'bad.txt', 'out.tsv']) == (
+        'db.csv', 'bad.txt', 'out.tsv', 'tsv', 0, 1)